@@ -6,16 +6,20 @@
 #   deja Año/Mes como enteros. El resto se exporta tal cual.
 # - Hoja "Datos_Deseados": construida desde "Datos_Limpiados" o desde un layout matriz,
 #   con tema blanco, bordes #e5e7eb, años/meses en negrilla y conceptos SIN negrilla.
+# - Perfil "borrador": mismas hojas como datos planos (sin estilos) para consumo automático.
+# - Histórico SQLite: cada carga guarda sus datos largos; /historico arma Datos_Deseados
+#   (vista previa o .xlsx) para cualquier lista de conceptos y rango de periodos.
 # - Interfaz: muestra un "Resumen de columnas" y una vista previa HTML de "Datos_Deseados".
 # - Autoabre el navegador en http://127.0.0.1:5000/
 # ------------------------------------------------------------------------------
 
-from flask import Flask, request, render_template_string, send_file
+from flask import Flask, request, render_template_string, send_file, jsonify
 import pandas as pd
 import numpy as np
 import unicodedata, re
-import io
+import io, csv, os, sqlite3
 import threading, time, webbrowser
+from concurrent.futures import ThreadPoolExecutor
 
 app = Flask(__name__)
 # Límite de carga de archivo: 20 MB
@@ -60,6 +64,11 @@ HTML = """
           <label>Seleccione un archivo (.xlsx o .csv):</label><br/>
           <input class="mt" type="file" name="file" accept=".xlsx,.csv" required />
           <p class="muted mt">Si es Excel, se usa la hoja <b>Base</b> si existe; si no, la primera hoja.</p>
+          <label>Perfil del anexo:</label>
+          <select name="perfil">
+            <option value="presentacion" selected>Presentación (con estilos)</option>
+            <option value="borrador">Borrador (datos planos, más rápido)</option>
+          </select>
         </div>
         <div>
           <button class="btn" type="submit">Validar y generar anexo</button>
@@ -137,9 +146,17 @@ HTML = """
 
     <!-- Botón de descarga -->
     {% if listo %}
-      <div class="mt">
-        <a class="btn" href="/download">Descargar anexo</a>
-      </div>
+      <form class="mt" method="GET" action="/download">
+        <p class="muted">Hojas a incluir en el anexo:</p>
+        <!-- Marca la selección explícita: sin casillas marcadas llega hojas= (vacío → error) -->
+        <input type="hidden" name="hojas" value="" />
+        {% for h in hojas %}
+          <label><input type="checkbox" name="hojas" value="{{ h }}" checked /> {{ h }}</label>
+        {% endfor %}
+        <div class="mt">
+          <button class="btn" type="submit">Descargar anexo</button>
+        </div>
+      </form>
     {% endif %}
   </div>
 
@@ -149,10 +166,37 @@ HTML = """
 </html>
 """
 
-# Buffer de salida del Excel y el resumen a mostrar
-buffer_xlsx = None
+# Resultados intermedios de la última carga (el anexo se arma al descargar),
+# perfil elegido en el formulario y el resumen a mostrar
+resultado_actual = None
+perfil_actual = "presentacion"
 resumen_reporte = None
 
+# Hojas del anexo (orden canónico); /download?hojas=... permite elegir un subconjunto
+HOJAS_ANEXO = ("Datos_Limpiados", "Validaciones", "Reporte_Columnas", "Datos_Deseados")
+
+# Bytes iniciales que se inspeccionan para detectar separador/decimal/tipos en CSV
+# (el encoding se decide decodificando el archivo completo: utf-8 → cp1252 → latin-1)
+CSV_SNIFF_BYTES = 64 * 1024
+
+# Perfiles de exportación del anexo:
+# - "presentacion": hojas con estilos (tema blanco, bordes, merges, anchos).
+# - "borrador": datos planos para consumo automático (sin formatos ni merges).
+PERFILES_EXPORT = ("presentacion", "borrador")
+# Opciones de xlsxwriter para el borrador: sin archivos temporales y sin
+# detección de URLs/fórmulas en cada string escrito
+XLSX_OPCIONES_BORRADOR = {"in_memory": True, "strings_to_urls": False, "strings_to_formulas": False}
+
+# Histórico SQLite de datos largos procesados (ruta configurable por variable de entorno)
+HISTORICO_DB = os.environ.get("ANEXO_HISTORICO_DB", "historico.sqlite")
+
+# Hilos para perfilar columnas en paralelo (tablas anchas); 0/1 = secuencial.
+# Un valor no numérico no impide arrancar la app: se usa el modo secuencial.
+try:
+    PERFILADO_WORKERS = int(os.environ.get("ANEXO_PERFILADO_WORKERS", "0").strip() or 0)
+except ValueError:
+    PERFILADO_WORKERS = 0
+
 # Mapas de meses
 MESES_ORDER = ["Ene","Feb","Mar","Abr","May","Jun","Jul","Ago","Sep","Oct","Nov","Dic"]
 MAP_MES_NOMBRE_A_NUM = {m:i+1 for i,m in enumerate(MESES_ORDER)}
@@ -165,6 +209,13 @@ CONCEPTOS_CANON = [
     "Tasa de Ocupación (TO)",
 ]
 
+# Alias (texto normalizado) para reconocer cada concepto canónico en las fuentes
+ALIASES_CONCEPTOS = {
+    "% población en edad de trabajar": ["poblacion en edad de trabajar","poblacion en ed trabajar","edad de trabajar"],
+    "Tasa Global de Participación (TGP)": ["tasa global de participacion","tgp","participacion"],
+    "Tasa de Ocupación (TO)": ["tasa de ocupacion","to","ocupacion"],
+}
+
 # ==============================================================================
 # Utilidades de limpieza/detección
 # ==============================================================================
@@ -179,6 +230,23 @@ def _normalize_text(s: str) -> str:
     s = re.sub(r"\s+", " ", s).strip()
     return s
 
+def _concepto_canonico(s: str) -> str:
+    """
+    Nombre canónico (CONCEPTOS_CANON) solo con coincidencia exacta: el texto normalizado
+    es el nombre canónico o un alias completo, o contiene la sigla (alias sin espacios de
+    hasta 3 letras: tgp, to) como palabra. Si no, devuelve el texto recortado.
+    (Los alias por subcadena solo se usan para ubicar filas en Datos_Deseados.)
+    """
+    n = _normalize_text(s)
+    palabras = set(n.split())
+    for canon in CONCEPTOS_CANON:
+        aliases = ALIASES_CONCEPTOS[canon]
+        if n == _normalize_text(canon) or n in aliases:
+            return canon
+        if any(len(a) <= 3 and " " not in a and a in palabras for a in aliases):
+            return canon
+    return str(s).strip()
+
 def _coerce_numeric_series(serie: pd.Series) -> pd.Series:
     """Convierte a numérico: quita NBSP, %, espacios y cambia coma decimal por punto."""
     s = (serie.astype(str)
@@ -226,6 +294,65 @@ def _leer_base_robusto(xls: pd.ExcelFile, sheet: str):
                 continue
     return df_simple, df_multi
 
+def _sniff_csv(raw: bytes) -> dict:
+    """
+    Detecta encoding, separador y coma decimal.
+    - encoding: se decide decodificando el archivo COMPLETO (la carga está limitada a
+      20 MB): utf-8 (con/sin BOM); si no decodifica, cp1252; si tampoco, latin-1.
+    - sep: csv.Sniffer sobre , ; tab |  en los primeros KB (por defecto ',').
+    - decimal: ',' si el separador no es coma y hay números tipo 77,9.
+    """
+    encoding = "latin-1"
+    for enc in ("utf-8-sig" if raw.startswith(b"\xef\xbb\xbf") else "utf-8", "cp1252"):
+        try:
+            raw.decode(enc); encoding = enc; break
+        except UnicodeDecodeError:
+            continue
+
+    sample = raw[:CSV_SNIFF_BYTES]
+    if len(raw) > CSV_SNIFF_BYTES and b"\n" in sample:
+        sample = sample[:sample.rfind(b"\n")]   # descarta la última línea cortada
+    text = sample.decode(encoding, errors="replace")
+
+    try:
+        sep = csv.Sniffer().sniff(text, delimiters=",;\t|").delimiter
+    except csv.Error:
+        sep = ","
+
+    decimal = "."
+    if sep != "," and len(re.findall(r"\d,\d", text)) > len(re.findall(r"\d\.\d", text)):
+        decimal = ","
+    return {"encoding": encoding, "sep": sep, "decimal": decimal, "sample": text}
+
+def _leer_csv_robusto(f) -> pd.DataFrame:
+    """
+    Lee un CSV detectando encoding/separador/decimal (_sniff_csv).
+    - Pre-declara dtypes numéricos a partir de la muestra (Int64 nullable/float64,
+      para que los faltantes después de la muestra no obliguen a re-leer).
+    - Usa el motor multihilo de pyarrow; si no está instalado o la muestra
+      no representa al archivo (dtype falla), cae al parser C sin dtypes.
+    """
+    raw = f.read()
+    opts = _sniff_csv(raw)
+    kw = {"sep": opts["sep"], "encoding": opts["encoding"], "decimal": opts["decimal"]}
+
+    # Tipos por columna desde la muestra (solo las que son 100% numéricas)
+    dtypes = {}
+    try:
+        muestra = pd.read_csv(io.StringIO(opts["sample"]), sep=kw["sep"], decimal=kw["decimal"])
+        for col in muestra.columns:
+            if pd.api.types.is_integer_dtype(muestra[col]):
+                dtypes[col] = "Int64"
+            elif pd.api.types.is_float_dtype(muestra[col]):
+                dtypes[col] = "float64"
+    except Exception:
+        dtypes = {}
+
+    try:
+        return pd.read_csv(io.BytesIO(raw), engine="pyarrow", dtype=dtypes or None, **kw)
+    except Exception:
+        return pd.read_csv(io.BytesIO(raw), engine="c", **kw)
+
 def _detectar_cols_anno_mes(df: pd.DataFrame):
     """Detecta columnas de Año y Mes probando alias comunes."""
     cols = {c: str(c).strip().lower() for c in df.columns}
@@ -255,94 +382,244 @@ def _normalizar_mes_a_num(serie_mes: pd.Series) -> pd.Series:
     return s_num.fillna(s_num2).astype("Int64")
 
 # ==============================================================================
-# Construcción de la VISTA PREVIA HTML (no afecta el archivo Excel)
+# Pivot concepto × (Año, Mes) sobre arreglos (reemplaza pivot_table)
 # ==============================================================================
 
-def _build_preview_datos_deseados(df_base: pd.DataFrame, df_multi: pd.DataFrame|None):
+def _pivot_concepto_anno_mes(conceptos: pd.Series, annos: np.ndarray,
+                             meses: np.ndarray, valores: np.ndarray):
     """
-    Devuelve un dict con:
-      - year_blocks: [{year: 2024, months: ["Ene","Feb",...]}...]
-      - rows: [{concepto: "...", values: ["77.90","78.00", ...]}...]
-    Para que Jinja construya la tabla de vista previa.
+    Factoriza concepto y (año, mes) a códigos enteros y dispersa los valores
+    en una matriz 2-D preasignada, detectando claves duplicadas en la misma pasada.
+    - Filas: conceptos ordenados; columnas: (año, mes) ordenadas.
+    - Con duplicados se conserva la PRIMERA fila (como aggfunc="first").
+    - Devuelve (pv, duplicados): duplicados = [(concepto, año, mes, n_filas), ...].
     """
-    def _fmt(v):
-        """Formato '0.00' para números; cadena vacía para NaN/None."""
-        try:
-            if v is None or (isinstance(v, float) and (pd.isna(v) or np.isinf(v))):
-                return ""
-            v = float(v)
-            return f"{v:.2f}"
-        except Exception:
-            return ""
+    cod_conc, conc_uniq = pd.factorize(conceptos, sort=True)
+    clave_am = annos.astype(np.int64) * 12 + (meses.astype(np.int64) - 1)
+    cod_am, am_uniq = pd.factorize(clave_am, sort=True)
+
+    n_r, n_c = len(conc_uniq), len(am_uniq)
+    flat = cod_conc.astype(np.int64) * n_c + cod_am
+
+    # Primera fila de cada celda (mínimo índice) y conteo por celda, en O(n)
+    primera = np.full(n_r * n_c, len(flat), dtype=np.int64)
+    np.minimum.at(primera, flat, np.arange(len(flat), dtype=np.int64))
+    conteo = np.bincount(flat, minlength=n_r * n_c)
 
+    mat = np.full(n_r * n_c, np.nan)
+    llenas = conteo > 0
+    mat[llenas] = valores[primera[llenas]]
+
+    dup = np.flatnonzero(conteo > 1)
+    am_dup = am_uniq.take(dup % max(n_c, 1))
+    duplicados = list(zip(conc_uniq.take(dup // max(n_c, 1)).tolist(),
+                          (am_dup // 12).tolist(), (am_dup % 12 + 1).tolist(),
+                          conteo[dup].tolist()))
+
+    columnas = pd.MultiIndex.from_arrays([(am_uniq // 12).astype(int), (am_uniq % 12 + 1).astype(int)])
+    pv = pd.DataFrame(mat.reshape(n_r, n_c), index=pd.Index(conc_uniq), columns=columnas)
+    return pv, duplicados
+
+def _datos_largos(df_largo: pd.DataFrame):
+    """
+    Layout largo (Año, Mes, Concepto, Valor) → DataFrame normalizado con
+    columnas concepto, anno, mes (1..12) y valor (float), sin filas incompletas.
+    Devuelve None si no se detectan las columnas de año/mes/concepto/valor.
+    """
+    col_anno, col_mes = _safe_anno_mes(df_largo)
+    if not (col_anno and col_mes):
+        return None
+
+    # Detección robusta de columnas de concepto/valor
+    norm_cols = {c: _normalize_text(c) for c in df_largo.columns}
+    def find_col(keys):
+        for c, n in norm_cols.items():
+            if any(k in n for k in keys): return c
+        return None
+    concept_col = find_col(["concepto","indicador","variable","serie",
+                            "poblacion en ed trabajar","poblacion en edad de trabajar"])
+    value_col   = find_col(["tasa global de participacion","tgp","valor","dato","medida"])
+    if not (concept_col and value_col):
+        return None
+
+    # Normaliza mes/año/valor y descarta filas sin clave o sin valor
+    mes   = _normalizar_mes_a_num(df_largo[col_mes])
+    anno  = pd.to_numeric(df_largo[col_anno], errors="coerce")
+    valor = _coerce_numeric_series(df_largo[value_col])
+    ok = (mes.isin(range(1, 13)).fillna(False) & anno.notna() & valor.notna()
+          & df_largo[concept_col].notna()).to_numpy(dtype=bool)
+
+    return pd.DataFrame({
+        "concepto": df_largo[concept_col][ok].astype(str).to_numpy(),
+        "anno":     anno[ok].to_numpy(dtype=np.int64),
+        "mes":      mes[ok].to_numpy(dtype=np.int64),
+        "valor":    valor[ok].to_numpy(dtype=float),
+    })
+
+def _pivot_tabla_larga(datos: pd.DataFrame|None):
+    """Pivot de la salida de _datos_largos (o del histórico) → (pv, duplicados) | None."""
+    if datos is None:
+        return None
+    return _pivot_concepto_anno_mes(datos["concepto"], datos["anno"].to_numpy(),
+                                    datos["mes"].to_numpy(), datos["valor"].to_numpy())
+
+def _pivot_datos_largos(df_largo: pd.DataFrame):
+    """Layout largo → (pv, duplicados); None si no aplica."""
+    return _pivot_tabla_larga(_datos_largos(df_largo))
+
+# ==============================================================================
+# Histórico SQLite: datos largos por carga, indexados por (concepto, año, mes)
+# ==============================================================================
+
+def _conectar_historico() -> sqlite3.Connection:
+    """Abre el histórico (HISTORICO_DB) y crea el esquema/índice si no existen."""
+    con = sqlite3.connect(HISTORICO_DB, timeout=30)
+    con.execute("PRAGMA journal_mode=WAL")   # lecturas concurrentes mientras se escribe
+    con.executescript("""
+        CREATE TABLE IF NOT EXISTS cargas (
+            id      INTEGER PRIMARY KEY AUTOINCREMENT,
+            archivo TEXT,
+            creado  TEXT    NOT NULL,
+            filas   INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS datos (
+            carga_id INTEGER NOT NULL REFERENCES cargas(id),
+            concepto TEXT    NOT NULL,
+            anno     INTEGER NOT NULL,
+            mes      INTEGER NOT NULL,
+            valor    REAL    NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS ix_datos_clave ON datos (concepto, anno, mes, carga_id);
+    """)
+    return con
+
+def _guardar_historico(datos: pd.DataFrame, archivo: str|None):
+    """
+    Guarda la salida de _datos_largos como una nueva carga (versión).
+    - Conceptos con nombre canónico (_concepto_canonico), para filtrar por alias.
+      Si varios conceptos de la fuente dan el mismo nombre canónico, ninguno se
+      renombra (se guardan con su texto original) y se informa la colisión.
+    - Una fila por (concepto, año, mes): con duplicados se conserva la primera,
+      igual que en Datos_Deseados (ya reportados como "Clave única").
+    - Devuelve (id de la carga, colisiones): colisiones = [(canónico, [conceptos fuente]), ...].
+    """
+    fuentes = datos["concepto"].str.strip()
+    canon = {c: _concepto_canonico(c) for c in fuentes.unique()}
+    por_canon = {}
+    for fuente, nombre in canon.items():
+        por_canon.setdefault(nombre, []).append(fuente)
+    colisiones = [(nombre, fs) for nombre, fs in por_canon.items() if len(fs) > 1]
+    for _nombre, fs in colisiones:
+        for fuente in fs: canon[fuente] = fuente
+    datos = datos.assign(concepto=fuentes.map(canon))
+    datos = datos.drop_duplicates(subset=["concepto", "anno", "mes"], keep="first")
+    con = _conectar_historico()
+    try:
+        with con:
+            cur = con.execute("INSERT INTO cargas (archivo, creado, filas) VALUES (?, ?, ?)",
+                              (archivo, time.strftime("%Y-%m-%d %H:%M:%S"), len(datos)))
+            carga_id = cur.lastrowid
+            con.executemany("INSERT INTO datos (carga_id, concepto, anno, mes, valor) VALUES (?, ?, ?, ?, ?)",
+                            ((carga_id, c, int(a), int(m), float(v))
+                             for c, a, m, v in datos.itertuples(index=False, name=None)))
+    finally:
+        con.close()
+    return carga_id, colisiones
+
+def _parse_periodo(txt: str|None, fin: bool = False):
+    """'2024-03' → (2024, 3); '2024' → (2024, 1) o (2024, 12) si fin=True; vacío → None."""
+    txt = (txt or "").strip()
+    if not txt:
+        return None
+    m = re.fullmatch(r"(\d{4})(?:[-/](\d{1,2}))?", txt)
+    if not m or not (1 <= int(m.group(2) or 1) <= 12):
+        raise ValueError(f"Periodo inválido: {txt!r}. Usa AAAA o AAAA-MM.")
+    return int(m.group(1)), int(m.group(2) or (12 if fin else 1))
+
+def _consultar_historico(conceptos: list|None = None, desde=None, hasta=None,
+                         carga: int|None = None) -> pd.DataFrame:
+    """
+    Consulta el histórico vía el índice (concepto, anno, mes, carga_id).
+    - conceptos: nombres o alias (p. ej. "TGP"); se comparan en forma canónica (None = todos).
+    - desde/hasta: (año, mes) inclusivos.
+    - carga: id de carga; si es None se toma la carga más reciente de cada clave.
+    Devuelve un DataFrame con columnas concepto, anno, mes, valor.
+    """
+    where, params = [], []
+    if conceptos:
+        conceptos = list(dict.fromkeys(_concepto_canonico(c) for c in conceptos))
+        where.append(f"d.concepto IN ({','.join('?' * len(conceptos))})"); params += list(conceptos)
+    if desde:
+        where.append("d.anno >= ? AND d.anno * 12 + d.mes >= ?"); params += [desde[0], desde[0] * 12 + desde[1]]
+    if hasta:
+        where.append("d.anno <= ? AND d.anno * 12 + d.mes <= ?"); params += [hasta[0], hasta[0] * 12 + hasta[1]]
+    if carga is not None:
+        where.append("d.carga_id = ?"); params.append(int(carga))
+    else:
+        where.append("d.carga_id = (SELECT MAX(x.carga_id) FROM datos x "
+                     "WHERE x.concepto = d.concepto AND x.anno = d.anno AND x.mes = d.mes)")
+
+    sql = "SELECT d.concepto, d.anno, d.mes, d.valor FROM datos d WHERE " + " AND ".join(where)
+    con = _conectar_historico()
+    try:
+        filas = con.execute(sql, params).fetchall()
+    finally:
+        con.close()
+    datos = pd.DataFrame(filas, columns=["concepto", "anno", "mes", "valor"])
+    return datos.astype({"concepto": str, "anno": np.int64, "mes": np.int64, "valor": float})
+
+# ==============================================================================
+# Matriz de "Datos_Deseados" (compartida por la vista previa y ambas hojas)
+# ==============================================================================
+
+def _matriz_datos_deseados(df_limpio: pd.DataFrame, df_multi: pd.DataFrame|None, largo=None,
+                           conceptos: list|None = None):
+    """
+    Devuelve un dict con:
+      - year_blocks: [(2024, [1, 2, ...]), ...]  (año, meses como número)
+      - rows: [("Tasa Global de Participación (TGP)", [77.9, np.nan, ...]), ...]
+    Valores float (NaN si falta); None si no hay layout largo ni matriz.
+    largo: resultado precalculado de _pivot_datos_largos (evita pivotear dos veces).
+    conceptos: filas a emitir, en ese orden y por nombre exacto (p. ej. desde el histórico);
+    None = CONCEPTOS_CANON ubicados por alias.
+    """
     # --- Opción 1: Layout largo (Anno, Mes, Concepto, Valor)
-    col_anno, col_mes = _safe_anno_mes(df_base)
-    if col_anno and col_mes:
-        df = df_base.copy()
-        df[col_mes] = _normalizar_mes_a_num(df[col_mes])
-
-        # Detecta columnas de concepto/valor por alias
-        norm_cols = {c: _normalize_text(c) for c in df.columns}
-        def find_col(keys):
-            for c, n in norm_cols.items():
-                if any(k in n for k in keys): return c
+    if largo is None:
+        largo = _pivot_datos_largos(df_limpio)
+    if largo is not None:
+        pv, _duplicados = largo
+
+        # Columnas ya ordenadas por (año, mes): bloques por año en una sola pasada
+        annos = pv.columns.get_level_values(0).to_numpy(dtype=np.int64)
+        meses = pv.columns.get_level_values(1).to_numpy(dtype=np.int64)
+        cortes = np.flatnonzero(np.diff(annos)) + 1
+        year_blocks = [(int(bloque_a[0]), bloque_m.tolist())
+                       for bloque_a, bloque_m in zip(np.split(annos, cortes), np.split(meses, cortes))
+                       if len(bloque_a)]
+
+        # Busca coincidencias fuzzy de filas de conceptos (posición en pv.index)
+        idx_norm_to_pos = {}
+        for i, ix in enumerate(pv.index.astype(str)):
+            idx_norm_to_pos[_normalize_text(ix)] = i
+        def pick(keys):
+            for k, i in idx_norm_to_pos.items():
+                if any(a in k for a in keys): return i
             return None
-
-        concept_col = find_col(["concepto","indicador","variable","serie",
-                                "poblacion en ed trabajar","poblacion en edad de trabajar"])
-        value_col   = find_col(["tasa global de participacion","tgp","valor","dato","medida"])
-
-        if concept_col and value_col:
-            # Limpia valor y filtra meses válidos
-            df[value_col] = _coerce_numeric_series(df[value_col])
-            df = df[df[col_mes].isin(range(1,13))]
-            df[col_anno] = pd.to_numeric(df[col_anno], errors="coerce").astype("Int64")
-            df = df.dropna(subset=[col_anno])
-            df[col_anno] = df[col_anno].astype(int)
-
-            # Pivot de filas=concepto, columnas=(año, mes)
-            pv = df.pivot_table(index=concept_col, columns=[col_anno, col_mes],
-                                values=value_col, aggfunc="first")
-            if isinstance(pv.columns, pd.MultiIndex) and len(pv.columns.levels) == 2:
-                pv.columns = pd.MultiIndex.from_tuples([(int(a), int(m)) for a, m in pv.columns])
-
-            # Define orden de columnas (año-mes) para render
-            year_blocks = []
-            order_cols = []
-            if len(pv.columns) > 0:
-                years = sorted({int(a) for a, _m in pv.columns})
-                for a in years:
-                    meses = sorted([int(m) for (aa, m) in pv.columns if int(aa) == a])
-                    if not meses: continue
-                    year_blocks.append({"year": a, "months": [MAP_MES_NUM_A_NOMBRE[m] for m in meses]})
-                    for m in meses:
-                        order_cols.append((a, m))
-
-            # Busca coincidencias fuzzy de filas de conceptos
-            idx_norm_to_orig = { _normalize_text(ix): ix for ix in pv.index.astype(str) }
-            def pick(aliases):
-                for k, orig in idx_norm_to_orig.items():
-                    if any(a in k for a in aliases): return orig
-                return None
-            aliases = {
-                "% población en edad de trabajar": ["poblacion en edad de trabajar","poblacion en ed trabajar","edad de trabajar"],
-                "Tasa Global de Participación (TGP)": ["tasa global de participacion","tgp","participacion"],
-                "Tasa de Ocupación (TO)": ["tasa de ocupacion","to","ocupacion"],
-            }
-            rows = []
-            for c in CONCEPTOS_CANON:
-                rk = pick(aliases[c])
-                vals = []
-                for a, m in order_cols:
-                    v = pv.at[rk, (a, m)] if (rk is not None and (a, m) in pv.columns) else np.nan
-                    vals.append(_fmt(v))
-                rows.append({"concepto": c, "values": vals})
-
-            return {"year_blocks": year_blocks, "rows": rows}
+        valores = pv.to_numpy(dtype=float)   # una fila completa por concepto, sin lecturas celda a celda
+        if conceptos is not None:
+            pos = {str(ix): i for i, ix in enumerate(pv.index)}
+            return {"year_blocks": year_blocks,
+                    "rows": [(c, valores[pos[c]].tolist() if c in pos else [np.nan] * len(annos))
+                             for c in conceptos]}
+        rows = []
+        for c in CONCEPTOS_CANON:
+            i = pick(ALIASES_CONCEPTOS[c])
+            rows.append((c, valores[i].tolist() if i is not None else [np.nan] * len(annos)))
+        return {"year_blocks": year_blocks, "rows": rows}
 
     # --- Opción 2: Layout matriz (MultiIndex)
     if (df_multi is not None) and isinstance(df_multi.columns, pd.MultiIndex):
-        dfm = df_multi.copy()
+        dfm = df_multi
         # Localiza la columna "Concepto"
         first_col = None
         for col in dfm.columns:
@@ -360,15 +637,13 @@ def _build_preview_datos_deseados(df_base: pd.DataFrame, df_multi: pd.DataFrame|
                 years.append(a)
         years = sorted(years, key=lambda x: int(x))
 
-        # Bloques año/mes para render
-        year_blocks = []
-        order_cols = []
+        # Bloques año/mes
+        year_blocks, order_cols = [], []
         for a in years:
             meses = [m for m in MESES_ORDER if (a, m) in dfm.columns]
             if not meses: continue
-            year_blocks.append({"year": int(a), "months": meses})
-            for m in meses:
-                order_cols.append((a, m))
+            year_blocks.append((int(a), [MAP_MES_NOMBRE_A_NUM[m] for m in meses]))
+            order_cols.extend((a, m) for m in meses)
 
         # Mapa fuzzy de nombres de fila
         nombres = dfm[first_col].astype(str).tolist()
@@ -377,44 +652,101 @@ def _build_preview_datos_deseados(df_base: pd.DataFrame, df_multi: pd.DataFrame|
             for nm, ii in norm2idx.items():
                 if any(k in nm for k in keys): return ii
             return None
-        fila_pet = find_idx(["poblacion en edad de trabajar","poblacion en ed trabajar","edad de trabajar"])
-        fila_tgp = find_idx(["tasa global de participacion","tgp","participacion"])
-        fila_to  = find_idx(["tasa de ocupacion","to","ocupacion"])
-        fila_map = {CONCEPTOS_CANON[0]: fila_pet, CONCEPTOS_CANON[1]: fila_tgp, CONCEPTOS_CANON[2]: fila_to}
 
-        # Armar filas para la vista previa
         rows = []
         for c in CONCEPTOS_CANON:
-            ridx = fila_map.get(c, None)
-            vals = []
-            for (a, m) in order_cols:
-                v = np.nan
-                try:
-                    if ridx is not None and (a, m) in dfm.columns:
-                        v = _coerce_numeric_series(pd.Series([dfm.iloc[ridx][(a, m)]]))[0]
-                except Exception:
-                    v = np.nan
-                vals.append(_fmt(v))
-            rows.append({"concepto": c, "values": vals})
-
+            ridx = find_idx(ALIASES_CONCEPTOS[c])
+            if ridx is None or not order_cols:
+                rows.append((c, [np.nan] * len(order_cols))); continue
+            vals = _coerce_numeric_series(pd.Series([dfm.iloc[ridx][col] for col in order_cols]))
+            rows.append((c, vals.tolist()))
         return {"year_blocks": year_blocks, "rows": rows}
 
-    # Si no se pudo construir la preview
     return None
 
+# ==============================================================================
+# Construcción de la VISTA PREVIA HTML (no afecta el archivo Excel)
+# ==============================================================================
+
+def _build_preview_datos_deseados(df_base: pd.DataFrame, df_multi: pd.DataFrame|None, largo=None,
+                                  conceptos: list|None = None):
+    """
+    Devuelve un dict con:
+      - year_blocks: [{year: 2024, months: ["Ene","Feb",...]}...]
+      - rows: [{concepto: "...", values: ["77.90","78.00", ...]}...]
+    Para que Jinja construya la tabla de vista previa.
+    largo: resultado precalculado de _pivot_datos_largos (p. ej. desde el histórico).
+    conceptos: filas a mostrar (ver _matriz_datos_deseados); None = CONCEPTOS_CANON.
+    """
+    def _fmt(v):
+        """Formato '0.00' para números; cadena vacía para NaN/None."""
+        try:
+            if v is None or (isinstance(v, float) and (pd.isna(v) or np.isinf(v))):
+                return ""
+            v = float(v)
+            return f"{v:.2f}"
+        except Exception:
+            return ""
+
+    mat = _matriz_datos_deseados(df_base, df_multi, largo, conceptos)
+    if mat is None:
+        return None   # Si no se pudo construir la preview
+    return {
+        "year_blocks": [{"year": a, "months": [MAP_MES_NUM_A_NOMBRE[m] for m in meses]}
+                        for a, meses in mat["year_blocks"]],
+        "rows": [{"concepto": c, "values": [_fmt(v) for v in vals]} for c, vals in mat["rows"]],
+    }
+
+# ==============================================================================
+# Hoja "Datos_Deseados" en perfil borrador (sin estilos)
+# ==============================================================================
+
+def _escribir_datos_deseados_borrador(writer: pd.ExcelWriter,
+                                      df_limpio: pd.DataFrame,
+                                      df_multi: pd.DataFrame|None,
+                                      largo=None, conceptos: list|None = None):
+    """
+    Hoja "Datos_Deseados" en perfil borrador: datos planos, sin formatos.
+    - Fila 1: Concepto + año repetido por columna; fila 2: meses (Ene..Dic).
+    - Sin merges, bordes ni rellenos; celdas NaN quedan vacías.
+    """
+    ws = writer.book.add_worksheet("Datos_Deseados")
+    ws.write(0, 0, "Concepto")
+    mat = _matriz_datos_deseados(df_limpio, df_multi, largo, conceptos)
+    if mat is None:
+        for i, concepto in enumerate(CONCEPTOS_CANON):
+            ws.write(2 + i, 0, concepto)
+        return
+
+    cc = 1
+    for a, meses in mat["year_blocks"]:
+        for m in meses:
+            ws.write_number(0, cc, a)
+            ws.write_string(1, cc, MAP_MES_NUM_A_NOMBRE[m])
+            cc += 1
+    for i, (concepto, vals) in enumerate(mat["rows"]):
+        r = 2 + i
+        ws.write_string(r, 0, concepto)
+        for j, v in enumerate(vals, start=1):
+            if pd.notna(v) and not np.isinf(v):
+                ws.write_number(r, j, float(v))
+
 # ==============================================================================
 # Escritura de la hoja Excel "Datos_Deseados" (tema blanco + bordes)
 # ==============================================================================
 
 def _escribir_datos_deseados_desde_limpios(writer: pd.ExcelWriter,
                                            df_limpio: pd.DataFrame,
-                                           df_multi: pd.DataFrame|None):
+                                           df_multi: pd.DataFrame|None,
+                                           largo=None, conceptos: list|None = None):
     """
     Construye la hoja "Datos_Deseados" sobre el writer (xlsxwriter).
     - Tema blanco (bg #FFFFFF), bordes #e5e7eb
     - Cabeceras de AÑO y MESES en negrilla
     - Columna "Concepto" SIN negrilla
     - Valores con formato numérico 0.00
+    - largo: resultado precalculado de _pivot_datos_largos (evita pivotear dos veces)
+    - conceptos: filas a emitir (ver _matriz_datos_deseados); None = CONCEPTOS_CANON
     """
     wb = writer.book
     ws = wb.add_worksheet("Datos_Deseados")
@@ -440,242 +772,132 @@ def _escribir_datos_deseados_desde_limpios(writer: pd.ExcelWriter,
     base_concept = {"align": "left",  "valign": "vcenter"}
     base_value   = {"align": "right", "valign": "vcenter"}
 
-    def mes_nom(n): return MAP_MES_NUM_A_NOMBRE.get(int(n), "")
+    mat = _matriz_datos_deseados(df_limpio, df_multi, largo, conceptos)
 
     first_data_row = 2                        # fila donde empiezan los conceptos
-    n_conceptos = len(CONCEPTOS_CANON)
+    n_conceptos = len(mat["rows"]) if mat is not None else len(CONCEPTOS_CANON)
     last_row = first_data_row + n_conceptos - 1
 
     # A1:A2 "Concepto" (con bordes externos y separador a la derecha)
     ws.merge_range(0, 0, 1, 0, "Concepto",
                    make_fmt(base_header, top=1, bottom=1, left=1, right=1))
-
-    # --- Opción 1: se puede construir desde layout largo
-    col_anno, col_mes = _safe_anno_mes(df_limpio)
-    if col_anno and col_mes:
-        df = df_limpio.copy()
-
-        # Detección robusta de columnas de concepto/valor
-        norm_cols = {c: _normalize_text(c) for c in df.columns}
-        def find_col(keys):
-            for c, n in norm_cols.items():
-                if any(k in n for k in keys): return c
-            return None
-        concept_col = find_col(["concepto","indicador","variable","serie",
-                                "poblacion en ed trabajar","poblacion en edad de trabajar"])
-        value_col   = find_col(["tasa global de participacion","tgp","valor","dato","medida"])
-
-        if concept_col and value_col:
-            # Normaliza mes y valor
-            df[col_mes]   = _normalizar_mes_a_num(df[col_mes])
-            df[value_col] = _coerce_numeric_series(df[value_col])
-            df = df[df[col_mes].isin(range(1, 13))]
-            df[col_anno] = pd.to_numeric(df[col_anno], errors="coerce").astype("Int64")
-            df = df.dropna(subset=[col_anno]); df[col_anno] = df[col_anno].astype(int)
-
-            # Pivot (filas=concepto, columnas=(año, mes))
-            pv = df.pivot_table(index=concept_col, columns=[col_anno, col_mes],
-                                values=value_col, aggfunc="first")
-            if isinstance(pv.columns, pd.MultiIndex) and len(pv.columns.levels) == 2:
-                pv.columns = pd.MultiIndex.from_tuples([(int(a), int(m)) for a, m in pv.columns])
-
-            # Define bloques por año y calcula última columna para bordes externos
-            year_blocks, col_ptr = [], 1
-            if len(pv.columns) > 0:
-                years = sorted({int(a) for a, _ in pv.columns})
-                for a in years:
-                    meses = sorted([int(m) for (aa, m) in pv.columns if int(aa) == a])
-                    if not meses: continue
-                    c0 = col_ptr; c1 = c0 + len(meses) - 1
-                    year_blocks.append((a, c0, c1, meses))
-                    col_ptr = c1 + 1
-            last_col = (col_ptr - 1) if col_ptr > 1 else 0
-
-            # Aplica relleno blanco en toda el área visible (tema)
-            white_fill = wb.add_format({"bg_color": "#FFFFFF", "pattern": 1})
-            ws.set_column(0, max(0, last_col), 12, white_fill)
-            for r in range(0, max(last_row, 1) + 1):
-                ws.set_row(r, None, white_fill)
-
-            # Cabeceras de AÑO (bordes externos izq/der en extremos)
-            for (a, c0, c1, _meses) in year_blocks:
-                ws.merge_range(0, c0, 0, c1, str(a),
-                               make_fmt(base_header, top=1,
-                                        right=(1 if c1 == last_col else 0),
-                                        left=(1 if c0 == 1 else 0)))
-            # Fila de MESES (borde superior e inferior)
-            for (_a, c0, _c1, meses) in year_blocks:
-                for k, m in enumerate(meses):
-                    cc = c0 + k
-                    ws.write(1, cc, mes_nom(m),
-                             make_fmt(base_month, top=1, bottom=1,
-                                      right=(1 if cc == last_col else 0),
-                                      left=(1 if cc == c0 else 0)))
-            # Columna Concepto (SIN negrilla; borde derecho como separador)
-            for i, concepto in enumerate(CONCEPTOS_CANON):
-                r = first_data_row + i
-                ws.write(r, 0, concepto,
-                         make_fmt(base_concept, left=1, right=1, bottom=(1 if r == last_row else 0)))
-
-            # Valores con formato 0.00 y bordes externos (derecha/abajo)
-            idx_norm_to_orig = { _normalize_text(ix): ix for ix in pv.index.astype(str) }
-            def pick(aliases):
-                for k, orig in idx_norm_to_orig.items():
-                    if any(a in k for a in aliases): return orig
-                return None
-            aliases = {
-                "% población en edad de trabajar": ["poblacion en edad de trabajar","poblacion en ed trabajar","edad de trabajar"],
-                "Tasa Global de Participación (TGP)": ["tasa global de participacion","tgp","participacion"],
-                "Tasa de Ocupación (TO)": ["tasa de ocupacion","to","ocupacion"],
-            }
-            for i, concepto in enumerate(CONCEPTOS_CANON):
-                r = first_data_row + i
-                rk = pick(aliases[concepto])
-                for (a, c0, _c1, meses) in year_blocks:
-                    for k, m in enumerate(meses):
-                        cc = c0 + k
-                        v = pv.at[rk, (a, m)] if (rk is not None and (a, m) in pv.columns) else np.nan
-                        ws.write(r, cc, v,
-                                 make_fmt(base_value,
-                                          right=(1 if cc == last_col else 0),
-                                          bottom=(1 if r == last_row else 0),
-                                          numfmt="0.00"))
-
-            # Anchos de columna
-            ws.set_column(0, 0, 42)
-            if last_col >= 1: ws.set_column(1, last_col, 12)
-            return
-
-    # --- Opción 2: reconstrucción desde una tabla matriz (MultiIndex)
-    if (df_multi is not None) and isinstance(df_multi.columns, pd.MultiIndex):
-        dfm = df_multi.copy()
-        # Localiza columna "Concepto"
-        first_col = None
-        for col in dfm.columns:
-            a = (col[0] if isinstance(col, tuple) and len(col)>0 else str(col))
-            if str(a).strip().lower() == "concepto":
-                first_col = col; break
-        if first_col is None: first_col = dfm.columns[0]
-
-        # Años presentes
-        years = []
-        for col in dfm.columns:
-            if col == first_col: continue
-            a = (col[0] if isinstance(col, tuple) and len(col)>0 else "")
-            if str(a).strip().isdigit() and (a not in years):
-                years.append(a)
-        years = sorted(years, key=lambda x: int(x))
-
-        # Bloques por año
-        year_blocks, col_ptr = [], 1
-        for a in years:
-            meses = [m for m in MESES_ORDER if (a, m) in dfm.columns]
-            if not meses: continue
-            c0 = col_ptr; c1 = c0 + len(meses) - 1
-            year_blocks.append((int(a), c0, c1, [MAP_MES_NOMBRE_A_NUM[m] for m in meses]))
-            col_ptr = c1 + 1
-        last_col = (col_ptr - 1) if col_ptr > 1 else 0
-
-        # Relleno blanco de tema
+    if mat is None:
+        # --- Fallback: si no hay meses/años, solo imprime la columna Concepto con tema
         white_fill = wb.add_format({"bg_color": "#FFFFFF", "pattern": 1})
-        ws.set_column(0, max(0, last_col), 12, white_fill)
-        for r in range(0, max(last_row, 1) + 1):
-            ws.set_row(r, None, white_fill)
-
-        # Cabeceras AÑO
-        for (a, c0, c1, _mn) in year_blocks:
-            ws.merge_range(0, c0, 0, c1, str(a),
-                           make_fmt(base_header, top=1,
-                                    right=(1 if c1 == last_col else 0),
-                                    left=(1 if c0 == 1 else 0)))
-        # Fila de MESES
-        for (_a, c0, _c1, mn) in year_blocks:
-            for k, m in enumerate(mn):
-                cc = c0 + k
-                ws.write(1, cc, MAP_MES_NUM_A_NOMBRE[m],
-                         make_fmt(base_month, top=1, bottom=1,
-                                  right=(1 if cc == last_col else 0),
-                                  left=(1 if cc == c0 else 0)))
-
-        # Columna Concepto
+        ws.set_column(0, 0, 42, white_fill)
         for i, concepto in enumerate(CONCEPTOS_CANON):
             r = first_data_row + i
-            ws.write(r, 0, concepto,
-                     make_fmt(base_concept, left=1, right=1, bottom=(1 if r == last_row else 0)))
-
-        # Mapa fuzzy para índices de fila
-        nombres = dfm[first_col].astype(str).tolist()
-        norm2idx = { _normalize_text(v): i for i, v in enumerate(nombres) }
-        def find_idx(keys):
-            for nm, ii in norm2idx.items():
-                if any(k in nm for k in keys): return ii
-            return None
-        fila_pet = find_idx(["poblacion en edad de trabajar","poblacion en ed trabajar","edad de trabajar"])
-        fila_tgp = find_idx(["tasa global de participacion","tgp","participacion"])
-        fila_to  = find_idx(["tasa de ocupacion","to","ocupacion"])
-        fila_map = {CONCEPTOS_CANON[0]: fila_pet, CONCEPTOS_CANON[1]: fila_tgp, CONCEPTOS_CANON[2]: fila_to}
-
-        # Escribe valores con formato 0.00
-        for i, concepto in enumerate(CONCEPTOS_CANON):
-            r = first_data_row + i
-            ridx = fila_map.get(concepto, None)
-            for (ay, c0, _c1, mn) in year_blocks:
-                for k, m in enumerate(mn):
-                    cc = c0 + k
-                    mtxt = MAP_MES_NUM_A_NOMBRE[m]
-                    v = np.nan
-                    try:
-                        if ridx is not None and (str(ay), mtxt) in dfm.columns:
-                            v = _coerce_numeric_series(pd.Series([dfm.iloc[ridx][(str(ay), mtxt)]]))[0]
-                    except Exception:
-                        v = np.nan
-                    ws.write(r, cc, v,
-                             make_fmt(base_value,
-                                      right=(1 if cc == last_col else 0),
-                                      bottom=(1 if r == last_row else 0),
-                                      numfmt="0.00"))
-
-        ws.set_column(0, 0, 42)
-        if last_col >= 1: ws.set_column(1, last_col, 12)
+            ws.set_row(r, None, white_fill)
+            ws.write(r, 0, concepto, make_fmt(base_concept, left=1, right=1, bottom=(1 if r == last_row else 0)))
         return
 
-    # --- Fallback: si no hay meses/años, solo imprime la columna Concepto con tema
+    # Define bloques por año y calcula última columna para bordes externos
+    year_blocks, col_ptr = [], 1
+    for a, meses in mat["year_blocks"]:
+        c0 = col_ptr; c1 = c0 + len(meses) - 1
+        year_blocks.append((a, c0, c1, meses))
+        col_ptr = c1 + 1
+    last_col = (col_ptr - 1) if col_ptr > 1 else 0
+
+    # Aplica relleno blanco en toda el área visible (tema)
     white_fill = wb.add_format({"bg_color": "#FFFFFF", "pattern": 1})
-    ws.set_column(0, 0, 42, white_fill)
-    for i, concepto in enumerate(CONCEPTOS_CANON):
-        r = first_data_row + i
+    ws.set_column(0, max(0, last_col), 12, white_fill)
+    for r in range(0, max(last_row, 1) + 1):
         ws.set_row(r, None, white_fill)
-        ws.write(r, 0, concepto, make_fmt(base_concept, left=1, right=1, bottom=(1 if r == last_row else 0)))
+
+    # Cabeceras de AÑO (bordes externos izq/der en extremos)
+    for (a, c0, c1, _meses) in year_blocks:
+        ws.merge_range(0, c0, 0, c1, str(a),
+                       make_fmt(base_header, top=1,
+                                right=(1 if c1 == last_col else 0),
+                                left=(1 if c0 == 1 else 0)))
+    # Fila de MESES (borde superior e inferior)
+    for (_a, c0, _c1, meses) in year_blocks:
+        for k, m in enumerate(meses):
+            cc = c0 + k
+            ws.write(1, cc, MAP_MES_NUM_A_NOMBRE[m],
+                     make_fmt(base_month, top=1, bottom=1,
+                              right=(1 if cc == last_col else 0),
+                              left=(1 if cc == c0 else 0)))
+
+    # Columna Concepto (SIN negrilla; borde derecho como separador) y valores 0.00
+    for i, (concepto, vals) in enumerate(mat["rows"]):
+        r = first_data_row + i
+        ws.write(r, 0, concepto,
+                 make_fmt(base_concept, left=1, right=1, bottom=(1 if r == last_row else 0)))
+        for cc, v in enumerate(vals, start=1):
+            fmt = make_fmt(base_value,
+                           right=(1 if cc == last_col else 0),
+                           bottom=(1 if r == last_row else 0),
+                           numfmt="0.00")
+            if pd.isna(v): ws.write_blank(r, cc, None, fmt)   # huecos: celda vacía con bordes
+            else:          ws.write(r, cc, v, fmt)
+
+    # Anchos de columna
+    ws.set_column(0, 0, 42)
+    if last_col >= 1: ws.set_column(1, last_col, 12)
 
 # ==============================================================================
 # Pipeline principal: validaciones + exportación de hojas + estilos
 # ==============================================================================
 
-def procesar_df(df_base: pd.DataFrame, df_multi: pd.DataFrame|None = None):
+def _perfilar_columna(serie: pd.Series):
+    """
+    Heurística numérica de UNA columna (≥70% convertible) + su validación de coerción.
+    Devuelve (serie_limpia | None si no es numérica, fila de reporte, validación | None).
+    No toca estado compartido: se puede ejecutar en paralelo por columna.
+    """
+    n_no_nulos = int(serie.notna().sum())
+    conv_test = pd.to_numeric(serie, errors="coerce")
+    porc = (conv_test.notna().sum() / n_no_nulos * 100) if n_no_nulos else 0.0
+    es_num = porc >= 70  # Umbral configurable
+    limpia = _coerce_numeric_series(serie) if es_num else None
+    fila = {
+        "columna": str(serie.name),
+        "tipo_detectado": "numérica" if es_num else "no numérica",
+        "no_nulos": n_no_nulos,
+        "porc_convertible": round(porc, 2),
+        "nulos_post_coerce": int((limpia if es_num else serie).isna().sum())
+    }
+
+    validacion = None
+    if es_num:
+        mask = limpia.isna() & serie.notna()
+        n_bad = int(mask.sum())
+        if n_bad>0:
+            ejemplos = serie[mask].astype(str).head(3).tolist()
+            validacion = {"regla":"Numérica coercible","columna":str(serie.name),
+                          "detalle":f"{n_bad} valores no numéricos. Ejemplos: {ejemplos}"}
+    return limpia, fila, validacion
+
+def _perfilar_df(df_base: pd.DataFrame, df_multi: pd.DataFrame|None = None,
+                 archivo: str|None = None, workers: int|None = None) -> dict:
     """
-    - Detecta columnas numéricas con heurística (≥70% convertible).
-    - Genera las hojas: Datos_Limpiados, Validaciones, Reporte_Columnas y Datos_Deseados.
-    - Devuelve el binario del Excel en memoria + resumen de columnas.
+    Parte del pipeline que se ejecuta al cargar (sin escribir el Excel):
+    - Detecta columnas numéricas con heurística (≥70% convertible) y arma validaciones.
+    - workers: hilos para perfilar columnas en paralelo (None = PERFILADO_WORKERS;
+      ≤1 = secuencial). El resultado es idéntico y en el orden original de columnas.
+    - Pivotea Datos_Deseados y, si se indica archivo, guarda los datos largos en el histórico
+      (id en res["carga_id"]; un fallo al guardar queda como validación).
+    - Devuelve los resultados intermedios que usa _escribir_anexo al descargar.
     """
     df_limpio = df_base.copy()
     reporte, validaciones = [], []
 
-    # Heurística numérica por columna
-    for col in df_base.columns:
-        serie = df_base[col]
-        n_no_nulos = int(serie.notna().sum())
-        conv_test = pd.to_numeric(serie, errors="coerce")
-        porc = (conv_test.notna().sum() / n_no_nulos * 100) if n_no_nulos else 0.0
-        es_num = porc >= 70  # Umbral configurable
-        if es_num:
-            df_limpio[col] = _coerce_numeric_series(serie)
-        reporte.append({
-            "columna": str(col),
-            "tipo_detectado": "numérica" if es_num else "no numérica",
-            "no_nulos": n_no_nulos,
-            "porc_convertible": round(porc, 2),
-            "nulos_post_coerce": int(df_limpio[col].isna().sum())
-        })
+    # Heurística numérica por columna (secuencial o repartida en un pool de hilos)
+    columnas = list(df_base.columns)
+    series = [df_base[col] for col in columnas]
+    n_workers = PERFILADO_WORKERS if workers is None else workers
+    if n_workers > 1 and len(series) > 1:
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            perfiles = list(pool.map(_perfilar_columna, series))   # map conserva el orden
+    else:
+        perfiles = [_perfilar_columna(serie) for serie in series]
+
+    for col, (limpia, fila, _val) in zip(columnas, perfiles):
+        if limpia is not None:
+            df_limpio[col] = limpia
+        reporte.append(fila)
 
     # Validaciones simples de ejemplo
     posibles_id = [c for c in df_base.columns if str(c).lower() in
@@ -685,66 +907,126 @@ def procesar_df(df_base: pd.DataFrame, df_multi: pd.DataFrame|None = None):
         if falt > 0:
             validaciones.append({"regla":"Obligatorio no nulo","columna":c,"detalle":f"{falt} valores faltantes"})
 
-    for r in reporte:
-        if r["tipo_detectado"]=="numérica":
-            col = r["columna"]
-            mask = df_limpio[col].isna() & df_base[col].notna()
-            n_bad = int(mask.sum())
-            if n_bad>0:
-                ejemplos = df_base.loc[mask, col].astype(str).head(3).tolist()
-                validaciones.append({"regla":"Numérica coercible","columna":col,
-                                     "detalle":f"{n_bad} valores no numéricos. Ejemplos: {ejemplos}"})
+    validaciones.extend(val for _limpia, _fila, val in perfiles if val is not None)
 
-    # --- Exportación de hojas a un Excel en memoria (BytesIO)
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
-        # 1) Datos_Limpiados (sin redondeo; formato se pone por columna)
-        df_out = _df_clean(df_limpio)
-        df_out.to_excel(writer, sheet_name="Datos_Limpiados", index=False, na_rep="")
+    # Pivot de Datos_Deseados (una sola pasada) + claves duplicadas como validación
+    datos_largos = _datos_largos(df_limpio)
+    largo = _pivot_tabla_larga(datos_largos)
+    if largo is not None:
+        for concepto, anno, mes, n in largo[1]:
+            validaciones.append({"regla":"Clave única (concepto, año, mes)","columna":str(concepto),
+                                 "detalle":f"{n} filas para {anno}-{mes:02d}; se usa la primera"})
 
-        # 2) Estilos SOLO para TGP (0.00) y Año/Mes (0)
-        wb = writer.book
-        ws_limpios = writer.sheets["Datos_Limpiados"]
-        fmt_2dec = wb.add_format({"num_format": "0.00"})
-        fmt_int  = wb.add_format({"num_format": "0"})
-
-        col_anno, col_mes = _safe_anno_mes(df_out)
+    # Histórico: persiste los datos largos (si no se puede, queda como advertencia)
+    carga_id = None
+    if archivo is not None and datos_largos is not None:
+        try:
+            carga_id, colisiones = _guardar_historico(datos_largos, archivo)
+            for nombre, fs in colisiones:
+                validaciones.append({"regla":"Histórico: concepto canónico","columna":nombre,
+                                     "detalle":f"{', '.join(fs)} equivalen al mismo concepto; "
+                                               "se guardan con su nombre original"})
+        except Exception as e:
+            validaciones.append({"regla":"Histórico","columna":"","detalle":f"No se pudo guardar: {e}"})
 
-        # Detecta la columna TGP por alias
-        norm_cols = {c: _normalize_text(c) for c in df_out.columns}
-        tgp_col = None
-        for c, n in norm_cols.items():
-            if ("tasa global de participacion" in n) or (n == "tgp") or ("global de participacion" in n):
-                tgp_col = c; break
-
-        # Aplica formato de números a las columnas seleccionadas
-        if tgp_col is not None:
-            j = df_out.columns.get_loc(tgp_col)
-            ws_limpios.set_column(j, j, 12, fmt_2dec)   # TGP = 0.00
-        if col_anno and col_anno in df_out.columns:
-            j = df_out.columns.get_loc(col_anno)
-            ws_limpios.set_column(j, j, 10, fmt_int)    # Año = 0
-        if col_mes and col_mes in df_out.columns:
-            j = df_out.columns.get_loc(col_mes)
-            ws_limpios.set_column(j, j, 10, fmt_int)    # Mes = 0
-
-        # Ancho razonable para el resto
-        for j, col in enumerate(df_out.columns):
-            if col in {tgp_col, col_anno, col_mes}:
-                continue
-            ws_limpios.set_column(j, j, 18)
+    return {"df_limpio": df_limpio, "df_multi": df_multi, "reporte": reporte,
+            "validaciones": validaciones, "largo": largo, "conceptos": None,
+            "carga_id": carga_id, "anexo": None}
 
-        # 3) Hojas de Validaciones/Reporte
-        (_df_clean(pd.DataFrame(validaciones)) if validaciones else
-         pd.DataFrame(columns=["regla","columna","detalle"]))\
-            .to_excel(writer, sheet_name="Validaciones", index=False, na_rep="")
-        _df_clean(pd.DataFrame(reporte)).to_excel(writer, sheet_name="Reporte_Columnas", index=False, na_rep="")
+def _escribir_anexo(res: dict, perfil: str = "presentacion", hojas=None) -> bytes:
+    """
+    Arma el Excel a partir de los resultados de _perfilar_df (al momento de descargar).
+    - perfil: "presentacion" (estilos completos) o "borrador" (datos planos, sin formatos).
+    - hojas: subconjunto de HOJAS_ANEXO (None = todas); se escriben en el orden canónico.
+    - Memoiza solo el último binario en res["anexo"] = ((perfil, hojas), bytes): una descarga
+      repetida no reescribe el Excel y la memoria queda acotada a un libro por carga.
+    """
+    if perfil not in PERFILES_EXPORT:
+        raise ValueError(f"Perfil de exportación no soportado: {perfil!r}. Usa {', '.join(PERFILES_EXPORT)}.")
+    hojas = tuple(h for h in HOJAS_ANEXO if hojas is None or h in hojas)
+    if not hojas:
+        raise ValueError(f"Selecciona al menos una hoja: {', '.join(HOJAS_ANEXO)}.")
+    clave = (perfil, hojas)
+    if res["anexo"] is not None and res["anexo"][0] == clave:
+        return res["anexo"][1]
+
+    df_limpio, df_multi, largo = res["df_limpio"], res["df_multi"], res["largo"]
+    conceptos = res["conceptos"]
+    reporte, validaciones = res["reporte"], res["validaciones"]
 
-        # 4) Hoja "Datos_Deseados" con tema y bordes
-        _escribir_datos_deseados_desde_limpios(writer, df_limpio, df_multi)
+    # --- Exportación de hojas a un Excel en memoria (BytesIO)
+    output = io.BytesIO()
+    opciones_xlsx = XLSX_OPCIONES_BORRADOR if perfil == "borrador" else {}
+    with pd.ExcelWriter(output, engine="xlsxwriter",
+                        engine_kwargs={"options": opciones_xlsx}) as writer:
+        # 1) Datos_Limpiados (sin redondeo; formato se pone por columna)
+        if "Datos_Limpiados" in hojas:
+            df_out = _df_clean(df_limpio)
+            df_out.to_excel(writer, sheet_name="Datos_Limpiados", index=False, na_rep="")
+
+        # 2) Estilos SOLO para TGP (0.00) y Año/Mes (0) — solo en perfil presentación
+        if "Datos_Limpiados" in hojas and perfil == "presentacion":
+            wb = writer.book
+            ws_limpios = writer.sheets["Datos_Limpiados"]
+            fmt_2dec = wb.add_format({"num_format": "0.00"})
+            fmt_int  = wb.add_format({"num_format": "0"})
+
+            col_anno, col_mes = _safe_anno_mes(df_out)
+
+            # Detecta la columna TGP por alias
+            norm_cols = {c: _normalize_text(c) for c in df_out.columns}
+            tgp_col = None
+            for c, n in norm_cols.items():
+                if ("tasa global de participacion" in n) or (n == "tgp") or ("global de participacion" in n):
+                    tgp_col = c; break
+
+            # Aplica formato de números a las columnas seleccionadas
+            if tgp_col is not None:
+                j = df_out.columns.get_loc(tgp_col)
+                ws_limpios.set_column(j, j, 12, fmt_2dec)   # TGP = 0.00
+            if col_anno and col_anno in df_out.columns:
+                j = df_out.columns.get_loc(col_anno)
+                ws_limpios.set_column(j, j, 10, fmt_int)    # Año = 0
+            if col_mes and col_mes in df_out.columns:
+                j = df_out.columns.get_loc(col_mes)
+                ws_limpios.set_column(j, j, 10, fmt_int)    # Mes = 0
+
+            # Ancho razonable para el resto
+            for j, col in enumerate(df_out.columns):
+                if col in {tgp_col, col_anno, col_mes}:
+                    continue
+                ws_limpios.set_column(j, j, 18)
 
-    output.seek(0)
-    return output, reporte, validaciones
+        # 3) Hojas de Validaciones/Reporte
+        if "Validaciones" in hojas:
+            (_df_clean(pd.DataFrame(validaciones)) if validaciones else
+             pd.DataFrame(columns=["regla","columna","detalle"]))\
+                .to_excel(writer, sheet_name="Validaciones", index=False, na_rep="")
+        if "Reporte_Columnas" in hojas:
+            _df_clean(pd.DataFrame(reporte)).to_excel(writer, sheet_name="Reporte_Columnas", index=False, na_rep="")
+
+        # 4) Hoja "Datos_Deseados": con tema y bordes (presentación) o plana (borrador)
+        if "Datos_Deseados" in hojas and perfil == "presentacion":
+            _escribir_datos_deseados_desde_limpios(writer, df_limpio, df_multi, largo, conceptos)
+        elif "Datos_Deseados" in hojas:
+            _escribir_datos_deseados_borrador(writer, df_limpio, df_multi, largo, conceptos)
+
+    res["anexo"] = (clave, output.getvalue())   # reemplaza el anterior (una sola entrada)
+    return res["anexo"][1]
+
+def procesar_df(df_base: pd.DataFrame, df_multi: pd.DataFrame|None = None,
+                perfil: str = "presentacion", archivo: str|None = None, hojas=None,
+                workers: int|None = None):
+    """
+    Pipeline completo (perfilado + Excel) en una sola llamada.
+    - perfil / hojas: ver _escribir_anexo; archivo / workers: ver _perfilar_df.
+    - Devuelve el binario del Excel en memoria + resumen de columnas + validaciones.
+    """
+    if perfil not in PERFILES_EXPORT:
+        raise ValueError(f"Perfil de exportación no soportado: {perfil!r}. Usa {', '.join(PERFILES_EXPORT)}.")
+    res = _perfilar_df(df_base, df_multi, archivo=archivo, workers=workers)
+    output = io.BytesIO(_escribir_anexo(res, perfil, hojas))
+    return output, res["reporte"], res["validaciones"]
 
 # ==============================================================================
 # Rutas Flask
@@ -754,20 +1036,27 @@ def procesar_df(df_base: pd.DataFrame, df_multi: pd.DataFrame|None = None):
 def index():
     """
     GET: muestra el formulario.
-    POST: procesa el archivo, arma el Excel y muestra resumen + vista previa.
+    POST: procesa el archivo y muestra resumen + vista previa (el Excel se arma en /download).
     """
-    global buffer_xlsx, resumen_reporte
+    global resultado_actual, perfil_actual, resumen_reporte
     if request.method == "POST":
         f = request.files.get("file")
         if not f or not f.filename:
             return render_template_string(HTML, mensaje="Adjunta un archivo (.xlsx o .csv).", listo=False)
 
+        # Perfil de exportación (formulario o ?perfil=borrador para clientes automáticos)
+        perfil = (request.values.get("perfil") or "presentacion").strip().lower()
+        if perfil not in PERFILES_EXPORT:
+            return render_template_string(HTML, mensaje=f"Perfil no soportado: {perfil}. Usa presentacion o borrador.", listo=False)
+        # historico=0 no guarda la carga en el histórico (pruebas de carga, ensayos)
+        guardar_historico = (request.values.get("historico") or "1").strip() != "0"
+
         fname = f.filename.lower()
         try:
             df_multi = None
             if fname.endswith(".csv"):
-                # Carga CSV directamente
-                df = pd.read_csv(f)
+                # Carga CSV detectando separador/encoding/decimal (motor pyarrow)
+                df = _leer_csv_robusto(f)
             elif fname.endswith(".xlsx"):
                 # Lee Excel: usa hoja 'Base' si existe, si no la primera
                 xls = pd.ExcelFile(f)
@@ -780,18 +1069,23 @@ def index():
             return render_template_string(HTML, mensaje=f"Error leyendo el archivo: {e}", listo=False)
 
         try:
-            # Genera el anexo y el resumen
-            buffer_xlsx, resumen_reporte, _ = procesar_df(df, df_multi)
-            # Construye la vista previa para la interfaz
-            preview = _build_preview_datos_deseados(df, df_multi)
+            # Perfila y valida; el Excel se arma recién al descargar (/download)
+            resultado_actual = _perfilar_df(df, df_multi, archivo=(f.filename if guardar_historico else None))
+            perfil_actual, resumen_reporte = perfil, resultado_actual["reporte"]
+            # Construye la vista previa para la interfaz (reutiliza el pivot ya calculado)
+            preview = _build_preview_datos_deseados(df, df_multi, largo=resultado_actual["largo"])
         except Exception as e:
             return render_template_string(HTML, mensaje=f"Error procesando datos: {e}", listo=False)
 
-        # Render con mensaje, resumen, preview y botón de descarga
+        # Render con mensaje (incluye la carga guardada en el histórico), resumen, preview y descarga
+        mensaje = "✅ Anexo listo."
+        if resultado_actual["carga_id"] is not None:
+            mensaje += f" Histórico: carga {resultado_actual['carga_id']}."
         return render_template_string(
             HTML,
-            mensaje="✅ Anexo listo.",
+            mensaje=mensaje,
             listo=True,
+            hojas=HOJAS_ANEXO,
             resumen=resumen_reporte,
             preview=preview
         )
@@ -799,14 +1093,96 @@ def index():
     # GET simple: solo el formulario
     return render_template_string(HTML, mensaje=None, listo=False)
 
+def _parse_hojas(valores: list):
+    """
+    ['Validaciones,datos_deseados'] → ('Validaciones', 'Datos_Deseados').
+    Parámetro ausente ([]) → None (todas); selección explícita vacía → ValueError.
+    """
+    if not valores:
+        return None
+    nombres = [v.strip() for txt in valores for v in str(txt).split(",") if v.strip()]
+    if not nombres:
+        raise ValueError(f"Selecciona al menos una hoja ({', '.join(HOJAS_ANEXO)}).")
+    por_nombre = {h.lower(): h for h in HOJAS_ANEXO}
+    desconocidas = [n for n in nombres if n.lower() not in por_nombre]
+    if desconocidas:
+        raise ValueError(f"Hojas no soportadas: {', '.join(desconocidas)}. Usa {', '.join(HOJAS_ANEXO)}.")
+    return tuple(por_nombre[n.lower()] for n in nombres)
+
 @app.route("/download")
 def download():
-    """Devuelve el archivo Excel generado como adjunto."""
-    if buffer_xlsx is None:
+    """
+    Arma y devuelve el anexo como adjunto a partir de la última carga.
+    Parámetros (query): hojas (p. ej. hojas=Datos_Deseados,Validaciones; sin el parámetro, todas;
+    hojas vacío → 400),
+    perfil (por defecto el elegido al cargar).
+    """
+    res = resultado_actual
+    if res is None:
         return render_template_string(HTML, mensaje="Primero carga y valida un archivo.", listo=False)
-    return send_file(buffer_xlsx, as_attachment=True, download_name="anexo.xlsx",
+    try:
+        hojas = _parse_hojas(request.args.getlist("hojas"))
+        perfil = (request.args.get("perfil") or perfil_actual).strip().lower()
+        data = _escribir_anexo(res, perfil, hojas)
+    except ValueError as e:
+        return render_template_string(HTML, mensaje=f"Error armando el anexo: {e}", listo=False), 400
+    return send_file(io.BytesIO(data), as_attachment=True, download_name="anexo.xlsx",
                      mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
 
+@app.route("/historico")
+def historico():
+    """
+    Datos_Deseados desde el histórico, sin re-procesar la fuente.
+    Parámetros (query): conceptos (separados por '|'), desde/hasta (AAAA o AAAA-MM),
+    carga (id; por defecto la más reciente por clave), formato (html|xlsx), perfil.
+    """
+    try:
+        conceptos = [c.strip() for c in request.args.get("conceptos", "").split("|") if c.strip()]
+        desde = _parse_periodo(request.args.get("desde"))
+        hasta = _parse_periodo(request.args.get("hasta"), fin=True)
+        carga = (request.args.get("carga") or "").strip()
+        if carga and not carga.isdigit():
+            raise ValueError(f"Carga inválida: {carga!r}. Usa el id numérico de /historico/cargas.")
+        carga = int(carga) if carga else None
+        formato = request.args.get("formato", "html").strip().lower()
+        perfil = request.args.get("perfil", "presentacion").strip().lower()
+        if perfil not in PERFILES_EXPORT:
+            raise ValueError(f"Perfil no soportado: {perfil}. Usa presentacion o borrador.")
+        datos = _consultar_historico(conceptos or None, desde, hasta, carga)
+    except Exception as e:
+        return render_template_string(HTML, mensaje=f"Error consultando el histórico: {e}", listo=False), 400
+
+    # Filas: conceptos pedidos (en ese orden) o, sin filtro, los devueltos (canónicos primero)
+    if conceptos:
+        filas = list(dict.fromkeys(_concepto_canonico(c) for c in conceptos))
+    else:
+        filas = sorted(datos["concepto"].unique(),
+                       key=lambda c: (CONCEPTOS_CANON.index(c) if c in CONCEPTOS_CANON
+                                      else len(CONCEPTOS_CANON), c))
+    largo = _pivot_tabla_larga(datos)
+    if formato == "xlsx":
+        res = {"df_limpio": pd.DataFrame(), "df_multi": None, "reporte": [],
+               "validaciones": [], "largo": largo, "conceptos": filas,
+               "carga_id": None, "anexo": None}
+        data = _escribir_anexo(res, perfil, ("Datos_Deseados",))
+        return send_file(io.BytesIO(data), as_attachment=True, download_name="datos_deseados.xlsx",
+                         mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+
+    preview = _build_preview_datos_deseados(pd.DataFrame(), None, largo, filas)
+    mensaje = (f"Histórico: {len(datos)} registros." if len(datos)
+               else "El histórico no tiene datos para ese filtro.")
+    return render_template_string(HTML, mensaje=mensaje, listo=False, preview=preview)
+
+@app.route("/historico/cargas")
+def historico_cargas():
+    """Lista las cargas (versiones) guardadas en el histórico."""
+    con = _conectar_historico()
+    try:
+        filas = con.execute("SELECT id, archivo, creado, filas FROM cargas ORDER BY id DESC").fetchall()
+    finally:
+        con.close()
+    return jsonify([{"id": i, "archivo": a, "creado": c, "filas": n} for i, a, c, n in filas])
+
 def _open_browser(url="http://127.0.0.1:5000/"):
     """Abre el navegador automáticamente al iniciar el servidor."""
     time.sleep(0.6)
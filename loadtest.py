@@ -0,0 +1,337 @@
+# loadtest.py — Prueba de carga local del flujo carga (POST /) → descarga (/download)
+# ------------------------------------------------------------------------------
+# Qué hace este script:
+# - Lanza N usuarios concurrentes que suben archivos sintéticos (.csv/.xlsx de varios
+#   tamaños) a la app y luego descargan el anexo.
+# - Reporta throughput, latencias p50/p95/p99 y tasa de errores por endpoint, y
+#   muestrea la memoria RSS del servidor (si se indica --pid) a lo largo de la prueba.
+# - Permite guardar un baseline (JSON) y comparar contra él antes de cada release:
+#   sale con código 1 si alguna métrica empeora más que la tolerancia.
+#
+# Uso típico (con la app corriendo en otra terminal: python app.py):
+#   python loadtest.py --usuarios 8 --duracion 30 --pid <PID de app.py>
+#   python loadtest.py --usuarios 8 --duracion 30 --guardar-baseline baseline.json
+#   python loadtest.py --usuarios 8 --duracion 30 --comparar baseline.json --tolerancia 0.20
+#
+# Las cargas se envían con historico=0 para no llenar historico.sqlite con datos
+# sintéticos; --guardar-historico las persiste (usar ANEXO_HISTORICO_DB desechable).
+# ------------------------------------------------------------------------------
+
+import argparse, json, math, random, re, sys
+import threading, time, uuid, io, zipfile
+import urllib.request, urllib.error, http.client
+
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+CONCEPTOS = [
+    "% población en edad de trabajar",
+    "Tasa Global de Participación (TGP)",
+    "Tasa de Ocupación (TO)",
+]
+
+# ==============================================================================
+# Archivos sintéticos (layout largo: Año, Mes, Concepto, Valor, Región)
+# ==============================================================================
+
+# Tope de periodos (meses) sintéticos: Datos_Deseados tiene una columna por periodo,
+# así que archivos más grandes crecen en conceptos (filas del pivot), no en columnas
+MAX_PERIODOS = 120
+
+def _filas_sinteticas(n_filas: int, seed: int = 0):
+    """
+    Genera n_filas con meses consecutivos desde 2015 (a lo sumo MAX_PERIODOS).
+    Los tres primeros conceptos son los canónicos; si no alcanzan los periodos,
+    se agregan indicadores sintéticos ("Indicador sintético 0001", ...).
+    """
+    rnd = random.Random(seed)
+    n_periodos = min(MAX_PERIODOS, max(1, math.ceil(n_filas / len(CONCEPTOS))))
+    n_conceptos = max(len(CONCEPTOS), math.ceil(n_filas / n_periodos))
+    for i in range(n_filas):
+        periodo, k = divmod(i, n_conceptos)
+        concepto = CONCEPTOS[k] if k < len(CONCEPTOS) else f"Indicador sintético {k - len(CONCEPTOS) + 1:04d}"
+        yield (2015 + periodo // 12, periodo % 12 + 1, concepto,
+               round(rnd.uniform(40, 80), 2), rnd.choice(["Bogotá", "Medellín", "Cali"]))
+
+def generar_csv(n_filas: int) -> bytes:
+    """CSV regional: separador ';', coma decimal y Latin-1."""
+    lineas = ["Año;Mes;Concepto;Valor;Región"]
+    for a, m, c, v, r in _filas_sinteticas(n_filas):
+        lineas.append(f"{a};{m};{c};{str(v).replace('.', ',')};{r}")
+    return ("\n".join(lineas) + "\n").encode("latin-1")
+
+def generar_xlsx(n_filas: int) -> bytes:
+    """Excel con hoja 'Base' (requiere pandas + xlsxwriter, igual que la app)."""
+    import pandas as pd
+    df = pd.DataFrame(list(_filas_sinteticas(n_filas)),
+                      columns=["Año", "Mes", "Concepto", "Valor", "Región"])
+    out = io.BytesIO()
+    df.to_excel(out, sheet_name="Base", index=False, engine="xlsxwriter")
+    return out.getvalue()
+
+def _parse_mezcla(txt: str):
+    """'csv:1000:3,xlsx:500:1' → [(tipo, filas, peso), ...]."""
+    mezcla = []
+    for parte in txt.split(","):
+        tipo, filas, peso = (parte.split(":") + ["1"])[:3]
+        tipo = tipo.strip().lower()
+        if tipo not in ("csv", "xlsx"):
+            raise ValueError(f"Tipo no soportado en --mezcla: {tipo!r} (usa csv o xlsx)")
+        mezcla.append((tipo, int(filas), float(peso)))
+    return mezcla
+
+# ==============================================================================
+# HTTP (solo biblioteca estándar)
+# ==============================================================================
+
+def _multipart(campos: dict, nombre: str, contenido: bytes):
+    """Arma un cuerpo multipart/form-data con un campo 'file' y campos de texto."""
+    boundary = uuid.uuid4().hex
+    partes = []
+    for k, v in campos.items():
+        partes.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{k}"\r\n\r\n{v}\r\n'.encode())
+    partes.append((f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{nombre}"\r\n'
+                   f'Content-Type: application/octet-stream\r\n\r\n').encode() + contenido + b"\r\n")
+    partes.append(f"--{boundary}--\r\n".encode())
+    return b"".join(partes), f"multipart/form-data; boundary={boundary}"
+
+def _pedir(req: urllib.request.Request, timeout: float, exito=None):
+    """
+    Ejecuta la petición; devuelve (ok, segundos, cuerpo).
+    exito(resp, cuerpo): validación adicional del contenido (la app responde 200
+    también con mensajes de error en la página).
+    """
+    t0 = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            cuerpo = resp.read()
+            ok = (resp.status == 200) and (exito is None or exito(resp, cuerpo))
+    except (urllib.error.URLError, http.client.HTTPException, OSError):
+        return False, time.perf_counter() - t0, b""
+    return ok, time.perf_counter() - t0, cuerpo
+
+# ==============================================================================
+# Métricas
+# ==============================================================================
+
+def _percentil(valores: list, p: float) -> float:
+    """Percentil por rango más cercano (valores en segundos)."""
+    if not valores:
+        return float("nan")
+    orden = sorted(valores)
+    k = max(0, min(len(orden) - 1, math.ceil(p / 100 * len(orden)) - 1))
+    return orden[k]
+
+def _rss_mb(pid: int):
+    """RSS del proceso en MB (psutil si está instalado; si no, /proc en Linux)."""
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss / 2**20
+    except ImportError:
+        pass
+    except Exception:
+        return None
+    try:
+        with open(f"/proc/{pid}/status") as fh:
+            for linea in fh:
+                if linea.startswith("VmRSS:"):
+                    return int(linea.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+class Resultados:
+    """Acumula (endpoint → latencias/errores) de forma segura entre hilos."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.lat = {"upload": [], "download": []}
+        self.err = {"upload": 0, "download": 0}
+        self.ajenos = 0   # descargas con el anexo de otra carga (cuentan como error)
+
+    def registrar(self, endpoint: str, ok: bool, seg: float, ajeno: bool = False):
+        with self.lock:
+            if ok: self.lat[endpoint].append(seg)
+            else:  self.err[endpoint] += 1
+            if ajeno: self.ajenos += 1
+
+    def resumen(self, duracion: float) -> dict:
+        res = {}
+        for ep in ("upload", "download"):
+            lat, n_err = self.lat[ep], self.err[ep]
+            total = len(lat) + n_err
+            res[ep] = {
+                "peticiones": total,
+                "throughput_rps": round(len(lat) / duracion, 3) if duracion else 0.0,
+                "p50_ms": round(_percentil(lat, 50) * 1000, 1),
+                "p95_ms": round(_percentil(lat, 95) * 1000, 1),
+                "p99_ms": round(_percentil(lat, 99) * 1000, 1),
+                "tasa_error": round(n_err / total, 4) if total else 0.0,
+            }
+        res["download"]["anexos_ajenos"] = self.ajenos
+        return res
+
+# ==============================================================================
+# Ejecución
+# ==============================================================================
+
+def _upload_ok(resp, cuerpo: bytes) -> bool:
+    """La carga solo cuenta como exitosa si la página confirma el anexo."""
+    return "Anexo listo" in cuerpo.decode("utf-8", errors="replace")
+
+def _download_ok(resp, cuerpo: bytes) -> bool:
+    """La descarga solo cuenta como exitosa si llega un .xlsx."""
+    return resp.headers.get_content_type() == XLSX_MIME
+
+def _filas_anexo(cuerpo: bytes):
+    """
+    Filas de datos de Datos_Limpiados (primera hoja del anexo) según su <dimension>;
+    None si no se puede leer. Sirve para detectar que /download devolvió el anexo
+    de otra carga: la app guarda una sola carga global (resultado_actual).
+    """
+    try:
+        with zipfile.ZipFile(io.BytesIO(cuerpo)) as zf, zf.open("xl/worksheets/sheet1.xml") as fh:
+            cabecera = fh.read(4096).decode("utf-8", errors="replace")
+    except (zipfile.BadZipFile, KeyError, OSError):
+        return None
+    m = re.search(r'<dimension ref="[A-Z]+\d+(?::[A-Z]+(\d+))?"', cabecera)
+    return (int(m.group(1) or 1) - 1) if m else None
+
+def ejecutar(url: str, usuarios: int, duracion: float, mezcla: list, perfil: str,
+             timeout: float, pid: int|None, intervalo_rss: float = 1.0,
+             guardar_historico: bool = False) -> dict:
+    """Corre la prueba y devuelve el resumen (dict serializable a JSON)."""
+    url = url.rstrip("/")
+    # Pre-genera un archivo por (tipo, filas) para no medir la generación
+    archivos = {}
+    for tipo, filas, _peso in mezcla:
+        if (tipo, filas) not in archivos:
+            archivos[(tipo, filas)] = generar_csv(filas) if tipo == "csv" else generar_xlsx(filas)
+    pesos = [p for _t, _f, p in mezcla]
+
+    res = Resultados()
+    fin = time.perf_counter() + duracion
+    rss = []
+    parar = threading.Event()
+
+    def usuario(idx: int):
+        rnd = random.Random(idx)
+        while time.perf_counter() < fin:
+            tipo, filas, _p = rnd.choices(mezcla, weights=pesos)[0]
+            campos = {"perfil": perfil, "historico": "1" if guardar_historico else "0"}
+            cuerpo, ctype = _multipart(campos, f"sintetico_{filas}.{tipo}", archivos[(tipo, filas)])
+            req = urllib.request.Request(url + "/", data=cuerpo, headers={"Content-Type": ctype})
+            ok, seg, _cuerpo = _pedir(req, timeout, _upload_ok)
+            res.registrar("upload", ok, seg)
+            if not ok:
+                continue
+            ok, seg, cuerpo = _pedir(urllib.request.Request(url + "/download"), timeout, _download_ok)
+            # Con usuarios concurrentes la descarga puede traer el anexo de otra carga
+            ajeno = ok and _filas_anexo(cuerpo) != filas
+            res.registrar("download", ok and not ajeno, seg, ajeno)
+
+    def muestrear_rss():
+        t0 = time.perf_counter()
+        while not parar.is_set():
+            mb = _rss_mb(pid)
+            if mb is not None:
+                rss.append((round(time.perf_counter() - t0, 1), round(mb, 1)))
+            parar.wait(intervalo_rss)
+
+    hilos = [threading.Thread(target=usuario, args=(i,), daemon=True) for i in range(usuarios)]
+    muestreo = threading.Thread(target=muestrear_rss, daemon=True) if pid else None
+    t0 = time.perf_counter()
+    if muestreo: muestreo.start()
+    for h in hilos: h.start()
+    for h in hilos: h.join()
+    real = time.perf_counter() - t0
+    parar.set()
+    if muestreo: muestreo.join()
+
+    return {
+        "config": {"url": url, "usuarios": usuarios, "duracion_s": duracion, "perfil": perfil,
+                   "historico": guardar_historico,
+                   "mezcla": [f"{t}:{f}:{p:g}" for t, f, p in mezcla]},
+        "duracion_real_s": round(real, 2),
+        "endpoints": res.resumen(real),
+        "rss_mb": {"muestras": rss,
+                   "max": max((mb for _t, mb in rss), default=None)},
+    }
+
+def comparar(actual: dict, baseline: dict, tolerancia: float) -> list:
+    """
+    Compara contra un baseline. Devuelve la lista de regresiones (texto):
+    latencias/RSS que suben o throughput que baja más que la tolerancia,
+    o tasa de error que sube más de 1 punto porcentual.
+    """
+    regresiones = []
+    for ep, m in actual["endpoints"].items():
+        b = baseline.get("endpoints", {}).get(ep)
+        if not b:
+            continue
+        for k in ("p50_ms", "p95_ms", "p99_ms"):
+            if b[k] and m[k] > b[k] * (1 + tolerancia):
+                regresiones.append(f"{ep}.{k}: {m[k]} > {b[k]} (+{tolerancia:.0%})")
+        if b["throughput_rps"] and m["throughput_rps"] < b["throughput_rps"] * (1 - tolerancia):
+            regresiones.append(f"{ep}.throughput_rps: {m['throughput_rps']} < {b['throughput_rps']} (-{tolerancia:.0%})")
+        if m["tasa_error"] > b["tasa_error"] + 0.01:
+            regresiones.append(f"{ep}.tasa_error: {m['tasa_error']} > {b['tasa_error']}")
+    b_rss, a_rss = baseline.get("rss_mb", {}).get("max"), actual["rss_mb"]["max"]
+    if b_rss and a_rss and a_rss > b_rss * (1 + tolerancia):
+        regresiones.append(f"rss_mb.max: {a_rss} > {b_rss} (+{tolerancia:.0%})")
+    return regresiones
+
+def _imprimir(resumen: dict):
+    """Tabla legible en consola."""
+    print(f"Duración: {resumen['duracion_real_s']} s · usuarios: {resumen['config']['usuarios']}"
+          f" · mezcla: {', '.join(resumen['config']['mezcla'])}")
+    print(f"{'endpoint':<10}{'pet.':>7}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'error':>8}")
+    for ep, m in resumen["endpoints"].items():
+        print(f"{ep:<10}{m['peticiones']:>7}{m['throughput_rps']:>9}{m['p50_ms']:>10}"
+              f"{m['p95_ms']:>10}{m['p99_ms']:>10}{m['tasa_error']:>8.2%}")
+    ajenos = resumen["endpoints"]["download"].get("anexos_ajenos", 0)
+    if ajenos:
+        print(f"Descargas con el anexo de otra carga (contadas como error): {ajenos}")
+    muestras = resumen["rss_mb"]["muestras"]
+    if muestras:
+        print(f"RSS servidor (MB): máx {resumen['rss_mb']['max']} · "
+              + " ".join(f"{t}s={mb}" for t, mb in muestras))
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Prueba de carga del flujo carga → descarga del anexo.")
+    ap.add_argument("--url", default="http://127.0.0.1:5000")
+    ap.add_argument("--usuarios", type=int, default=4, help="usuarios concurrentes")
+    ap.add_argument("--duracion", type=float, default=20, help="segundos de prueba")
+    ap.add_argument("--mezcla", default="csv:300:3,csv:30000:1,xlsx:300:1",
+                    help="tipo:filas:peso separados por coma (tipo = csv|xlsx)")
+    ap.add_argument("--perfil", default="presentacion", choices=["presentacion", "borrador"])
+    ap.add_argument("--timeout", type=float, default=120)
+    ap.add_argument("--guardar-historico", action="store_true",
+                    help="guarda las cargas sintéticas en el histórico (por defecto historico=0)")
+    ap.add_argument("--pid", type=int, default=None, help="PID del servidor para muestrear RSS")
+    ap.add_argument("--json", dest="salida_json", default=None, help="guarda el resumen en este archivo")
+    ap.add_argument("--guardar-baseline", default=None, help="guarda el resumen como baseline")
+    ap.add_argument("--comparar", default=None, help="baseline JSON contra el cual comparar")
+    ap.add_argument("--tolerancia", type=float, default=0.20, help="margen relativo permitido (0.20 = 20%%)")
+    args = ap.parse_args(argv)
+
+    resumen = ejecutar(args.url, args.usuarios, args.duracion, _parse_mezcla(args.mezcla),
+                       args.perfil, args.timeout, args.pid,
+                       guardar_historico=args.guardar_historico)
+    _imprimir(resumen)
+
+    for ruta in filter(None, [args.salida_json, args.guardar_baseline]):
+        with open(ruta, "w", encoding="utf-8") as fh:
+            json.dump(resumen, fh, ensure_ascii=False, indent=2)
+
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as fh:
+            regresiones = comparar(resumen, json.load(fh), args.tolerancia)
+        if regresiones:
+            print("REGRESIONES vs baseline:")
+            for r in regresiones:
+                print("  - " + r)
+            return 1
+        print("Sin regresiones vs baseline.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())